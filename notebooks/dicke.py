@@ -23,11 +23,11 @@ t_start = time.time()
 while n_iter > 0:
     print('Segments remaining:', n_iter, 'Elapsed time:', time.time() - t_start)
     ts, ps, noise_on = col.dicke(262144//8, 35.0, 2.32e6, 1420.4e6, t_per_iter, plot=False, sdr=sdr)
-    t_arr += ts
-    p_arr += ps
-    noise_on_arr += noise_on
+    t_arr.append(ts)
+    p_arr.append(ps)
+    noise_on_arr.append(noise_on)
     n_iter -= 1
 sdr.close()
 ut.biast(0, index=0, gpio=0)
 
-np.savez(f'../output/{t_start}_data_chunks.npz',  t=t_arr, p=p_arr, noise_on=noise_on_arr)
\ No newline at end of file
+np.savez(f'../output/{t_start}_data_chunks.npz',  t=np.concatenate(t_arr), p=np.concatenate(p_arr), noise_on=np.concatenate(noise_on_arr))
\ No newline at end of file
@@ -4,15 +4,127 @@ by Evan Mayer
 Library for data collection functions on an rtl-sdr based radio telescope.
 '''
 
+from collections import deque
+from contextlib import closing
 import logging
 import numpy as np
-from scipy.signal import welch, get_window
-import sys
+from scipy.fft import fft, fftfreq
+from scipy.signal import get_window
+import threading
 import time
 
 from rtlsdr import RtlSdr
 import rtlsdr.helpers as helpers
 
+try:
+    from numba import njit, prange, vectorize
+except ImportError:
+    njit = None
+
+
+def _dc_and_power_numpy(re, im):
+    '''
+    Total power I^2 + Q^2 summed over an IQ timeseries, after removing the
+    DC offset of each of the real and imaginary parts.
+
+    Uses sum((x - mean)^2) = sum(x^2) - (sum(x))^2 / n, so the DC offset is
+    never subtracted from a copy of the buffer. Since removing the DC offset
+    makes the result independent of any constant offset in the samples, the
+    I and Q bytes read from the SDR may be passed directly.
+    '''
+    # avoid overflowing integer dot products when given raw bytes
+    re = re.astype(np.float64, copy=False)
+    im = im.astype(np.float64, copy=False)
+    n = re.size
+    sr = re.sum()
+    si = im.sum()
+    return re.dot(re) + im.dot(im) - (sr*sr + si*si) / n
+
+
+if njit is None:
+    _dc_and_power = _dc_and_power_numpy
+else:
+    @njit(cache=True, fastmath=True, parallel=True)
+    def _dc_and_power(re, im):
+        # Same as _dc_and_power_numpy, but compiled into a single pass over
+        # the buffer accumulating the sums and the sum of squares together.
+        sr = 0.0
+        si = 0.0
+        sq = 0.0
+        for k in prange(re.size):
+            a = np.float64(re[k])
+            b = np.float64(im[k])
+            sr += a
+            si += b
+            sq += a*a + b*b
+        return sq - (sr*sr + si*si) / re.size
+
+
+def _abs2(z):
+    '''
+    Squared magnitude |z|^2 of complex values, without the square root of
+    np.abs() or any complex intermediate.
+    '''
+    return z.real*z.real + z.imag*z.imag
+
+
+if njit is not None:
+    # As a numba ufunc, this is a single fused pass with no temporaries.
+    # Without signatures it is compiled on first use for each input dtype
+    # (and cached), so importing this module costs no compile time.
+    _abs2 = vectorize(cache=True, fastmath=True)(_abs2)
+
+
+# Number of calls to the SDR whose samples are buffered and processed
+# together when estimating power spectra
+_BATCH_CALLS = 8
+
+
+def _sum_spectra(iq, win, nfft):
+    '''
+    Estimate the power spectrum of each row of a 2D array of IQ timeseries,
+    following Bartlett's method as described in `run_spectrum_int`, and sum
+    the spectra over rows.
+
+    This is equivalent to summing the output of
+    `scipy.signal.welch(row, window=win, nperseg=len(win), nfft=nfft,
+    noverlap=0, scaling='spectrum', detrend=False, return_onesided=False)`
+    over rows, without the per-call overhead of welch(). `iq` is used as
+    scratch space: the DC spike is removed and the window applied in place.
+
+    Parameters
+    ----------
+    iq
+        2D array of IQ timeseries, one per row. Use complex64 (with a
+        float32 `win`) for single precision FFTs.
+    win
+        Window applied to each segment; its length sets the segment length
+    nfft
+        Length of the FFT of each segment, i.e. number of frequency bins
+
+    Returns
+    -------
+    p_xx
+        Sum of the power spectra of all rows, in FFT order (see `fftfreq`)
+    '''
+    nperseg = len(win)
+    nseg = iq.shape[-1] // nperseg
+    # compensate for DC spike
+    iq -= iq.mean(axis=-1, keepdims=True)
+    # Split each row into non-overlapping segments, dropping any leftover
+    # samples at the end as welch() does, and window every segment at once.
+    # This is a view of iq unless samples had to be dropped.
+    segs = iq[:, :nseg * nperseg].reshape(-1, nperseg)
+    segs *= win
+    # IQ samples are complex, so the positive and negative frequencies (above
+    # and below fc) carry independent power: a full complex FFT is needed,
+    # a real-input rfft of I and Q would fold them together.
+    spec = fft(segs, n=nfft, axis=-1, overwrite_x=True, workers=-1)
+    # Accumulate in double precision, since there may be many segments
+    p_xx = _abs2(spec).sum(axis=0, dtype=np.float64)
+    # Average over segments and apply welch()'s "spectrum" scaling
+    return p_xx / (nseg * win.sum()**2)
+
 
 def get_sdr(rate=2.32e6, fc=1.4204e9, gain=35.0):
     # Start the RtlSdr instance
@@ -27,6 +139,94 @@ def get_sdr(rate=2.32e6, fc=1.4204e9, gain=35.0):
     return sdr
 
 
+def _stream_samples(sdr, num_samp, num_calls):
+    '''
+    Generator yielding `num_calls` arrays of `num_samp` IQ samples each,
+    streamed from the SDR with `read_samples_async` in a background thread.
+
+    The SDR callback only hands each buffer over and signals the consumer,
+    so USB transfers carry on while the caller processes earlier samples. If
+    the caller falls more than a few batches behind, the stream blocks, as
+    synchronous reads would. Close the generator (e.g. with
+    `contextlib.closing`) to stop the stream early.
+    '''
+    max_queued = 2 * _BATCH_CALLS
+    # deque appends and pops are atomic, so the only synchronization needed
+    # is to wake up whichever side is waiting on the other
+    samples = deque()
+    added = threading.Event()
+    taken = threading.Event()
+    calls = [0]
+    # Whether the async read is running, and whether it has been cancelled.
+    # Cancelling a read that is not running makes pyrtlsdr close the device
+    # and raise, so the two flags are only changed together under the lock.
+    lock = threading.Lock()
+    running = [False]
+    cancelled = [False]
+
+    def cancel():
+        with lock:
+            if running[0] and not cancelled[0]:
+                cancelled[0] = True
+                sdr.cancel_read_async()
+
+    def callback(iq, context):
+        with lock:
+            running[0] = True
+            if cancelled[0]:
+                return
+        if calls[0] >= num_calls:
+            cancel()
+            return
+        while len(samples) >= max_queued:
+            taken.wait()
+            taken.clear()
+        samples.append(iq)
+        added.set()
+        calls[0] += 1
+        # stop as soon as the last buffer is handed over, rather than waiting
+        # a whole buffer for the next callback
+        if calls[0] >= num_calls:
+            cancel()
+
+    def reader():
+        try:
+            sdr.read_samples_async(callback, num_samples=num_samp)
+        except Exception as err:
+            samples.append(err)
+        samples.append(None)
+        added.set()
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    done = False
+    try:
+        while True:
+            while not samples:
+                added.wait()
+                added.clear()
+            iq = samples.popleft()
+            taken.set()
+            if iq is None:
+                done = True
+                break
+            if isinstance(iq, Exception):
+                # the reader has already left read_samples_async
+                done = True
+                raise iq
+            yield iq
+    finally:
+        if not done:
+            # the caller gave up early: stop streaming, and keep discarding
+            # samples so the reader is never left waiting, until it exits
+            while thread.is_alive():
+                cancel()
+                samples.clear()
+                taken.set()
+                thread.join(timeout=0.1)
+        thread.join()
+
+
 def run_total_power_int(num_samp, gain, rate, fc, t_int, sdr=None):
     '''
     Implement a total-power radiometer.
@@ -84,27 +284,32 @@ def run_total_power_int(num_samp, gain, rate, fc, t_int, sdr=None):
         logging.debug('  => num samples to collect: {}'.format(N))
         logging.debug('  => est. num of calls: {}'.format(int(N / num_samp)))
 
-        global p_tot
-        global cnt
-        p_tot = 0.0
-        cnt = 0
+        # Accumulators live in mutable containers closed over by the
+        # callback, rather than module globals
+        p_tot = np.zeros(1)
+        cnt = [0]
 
         # Set the baseline time
         start_time = time.time()
         logging.info('Integration began at {}'.format(time.strftime('%a, %d %b %Y %H:%M:%S', time.localtime(start_time))))
 
         # Time integration loop
+        # Read the raw interleaved I/Q bytes rather than complex samples:
+        # pyrtlsdr would otherwise convert every byte to a double,
+        # iq = b / 127.5 - (1 + 1j), only for us to reduce it to one number.
         @helpers.limit_calls(N / num_samp)
-        def p_tot_callback(iq, context):
+        def p_tot_callback(buf, context):
             # The below is a total power measurement equivalent to summing
             # P = V^2 / R = (sqrt(I^2 + Q^2))^2 = (I^2 + Q^2)
-            global p_tot
-            # compensate for DC spike
-            iq = (iq.real - iq.real.mean()) + (1j * (iq.imag - iq.imag.mean()))
-            p_tot += np.sum(np.real(iq * np.conj(iq)))
-            global cnt 
-            cnt += 1
-        sdr.read_samples_async(p_tot_callback, num_samples=num_samp)
+            # compensate for DC spike and sum power in one pass. The DC
+            # removal also removes the 127.5 byte offset, leaving only the
+            # scale to convert to pyrtlsdr's sample units.
+            b = np.frombuffer(buf, dtype=np.uint8)
+            p_tot[0] += _dc_and_power(b[0::2], b[1::2]) / 127.5**2
+            cnt[0] += 1
+        sdr.read_bytes_async(p_tot_callback, num_bytes=2 * num_samp)
+        p_tot = p_tot[0]
+        cnt = cnt[0]
         
         end_time = time.time()
         logging.info('Integration ended at {} after {} seconds.'.format(time.strftime('%a, %d %b %Y %H:%M:%S'), end_time-start_time))
@@ -120,8 +325,8 @@ def run_total_power_int(num_samp, gain, rate, fc, t_int, sdr=None):
             # nice and tidy
             sdr.close()
 
-    except:
-        print('Unexpected error:', sys.exc_info()[0])
+    except Exception:
+        logging.exception('sdr loop failed')
         raise
     finally:
         if sdr is not None and close_sdr:
@@ -160,13 +365,13 @@ def dicke(num_samp, gain, rate, fc, t, sdr=None, plot=False):
     Returns
     -------
     ts
-        UNIX time at which each total power measurement was collected
+        Array, UNIX time at which each total power measurement was collected
     ps
-        Total power measurement from the receiver
+        Array, total power measurement from the receiver
     noise_on
-        [0, 1] denoting whether the GPIO was turned on. It is assumed that the
-        GPIO is connected to a switch that swaps the antenna input to a matched
-        load.
+        Array of [0, 1] denoting whether the GPIO was turned on. It is assumed
+        that the GPIO is connected to a switch that swaps the antenna input to
+        a matched load.
     '''
 
     if plot:
@@ -175,10 +380,9 @@ def dicke(num_samp, gain, rate, fc, t, sdr=None, plot=False):
         fig, ax = plt.subplots()
         plt.ion()
         plt.show()
+        # Number of most recent measurements to plot
         window_size = 300
-        t_window = np.arange(window_size)
-        p_window = np.zeros(window_size)
-        line, = ax.plot(t_window, p_window)
+        line, = ax.plot([], [])
         fig.canvas.flush_events()
         fig.canvas.draw()
 
@@ -204,13 +408,13 @@ def dicke(num_samp, gain, rate, fc, t, sdr=None, plot=False):
         # Set a GPIO pin (RTL-SDRblog v3 header 31) as noise source trigger
         sdr.set_gpio_output(4)
 
-        ts = []
-        ps = []
-        noise_on = []
+        num_calls = N // num_samp
+        ts = np.empty(num_calls)
+        ps = np.empty(num_calls)
+        noise_on = np.empty(num_calls, dtype=np.uint8)
         flipflop = 1
-        for i in range(N // num_samp):
+        for i in range(num_calls):
             curtime = time.time()
-            time_str = time.strftime('%a, %d %b %Y %H:%M:%S', time.localtime(curtime))
 
             if flipflop:
                 sdr.set_gpio_bit(4, 1)
@@ -219,45 +423,47 @@ def dicke(num_samp, gain, rate, fc, t, sdr=None, plot=False):
 
             iq = sdr.read_samples(num_samp)
             # compensate for DC spike
-            iq = (iq.real - iq.real.mean()) + (1j * (iq.imag - iq.imag.mean()))
-            p_tot = np.sum(np.real(iq * np.conj(iq)))
+            iq -= iq.mean()
+            # sum of conj(iq) * iq = I^2 + Q^2 in a single BLAS call
+            p_tot = np.vdot(iq, iq).real
             
-            ts.append(curtime)
-            ps.append(p_tot)
-            noise_on.append(flipflop)
+            ts[i] = curtime
+            ps[i] = p_tot
+            noise_on[i] = flipflop
             flipflop = 1 - flipflop
 
-            if plot:
-                if len(ts) < 4:
+            # Each noise-off measurement completes an on/off pair with the
+            # one before it, so the plot only changes then
+            if plot and not noise_on[i]:
+                start = max(i + 1 - window_size, 0)
+                t_window = ts[start:i + 1]
+                p_window = ps[start:i + 1]
+                mask_off = noise_on[start + 1:i + 1] == 0
+                if np.count_nonzero(mask_off) < 2:
                     continue
-                elif len(ts) < window_size:
-                    cur_window = len(ts)
-                else:
-                    cur_window = window_size
-                noise_on_window = noise_on[-cur_window:]
-                t_window = ts[-cur_window:]
-                p_window = ps[-cur_window:]
-                mask_off = np.where(np.array(noise_on_window) < 1)[0]
-                t_interp = [((t_window[i] + t_window[i-1]) / 2) for i in mask_off]
-                p_window_dicke = [((p_window[i] - p_window[i-1])) for i in mask_off]
-
-                line.set_xdata(t_interp[1:])
-                line.set_ydata(p_window_dicke[1:])
-                ax.set_xlim(np.min(t_interp[1:]), np.max(t_interp[1:]))
-                ax.set_ylim(0.9 * np.min(p_window_dicke[1:]), 1.1 * np.max(p_window_dicke[1:]))
+                # Difference and midpoint time of each pair
+                t_interp = ((t_window[1:] + t_window[:-1]) / 2)[mask_off]
+                p_window_dicke = np.diff(p_window)[mask_off]
+
+                line.set_xdata(t_interp)
+                line.set_ydata(p_window_dicke)
+                ax.set_xlim(t_interp[0], t_interp[-1])
+                ax.set_ylim(0.9 * p_window_dicke.min(), 1.1 * p_window_dicke.max())
                 ax.autoscale_view()
                 fig.canvas.flush_events()
                 fig.canvas.draw()
 
-        np.save(f'../output/dicke_timeseries_{time_str}.npy', np.array([ts, ps, noise_on]))
+        # The output file is named for the end of the timeseries
+        time_str = time.strftime('%a, %d %b %Y %H:%M:%S', time.localtime(time.time()))
+        np.save(f'../output/dicke_timeseries_{time_str}.npy', np.vstack([ts, ps, noise_on]))
 
         if close_sdr:
             # nice and tidy
             sdr.set_gpio_bit(4, 0)
             sdr.close()
 
-    except:
-        print('Unexpected error:', sys.exc_info()[0])
+    except Exception:
+        logging.exception('sdr loop failed')
         raise
     finally:
         if sdr is not None and close_sdr:
@@ -298,13 +504,25 @@ def run_spectrum_int(num_samp, nbins, gain, rate, fc, t_int, sdr=None):
     # Force a choice of window to allow converting to PSD after averaging
     # power spectra
     WINDOW = 'hann'
-    # Force a default nperseg for welch() because we need to get a window
-    # of this size later. Use the scipy default 256, but enforce scipy 
-    # conditions on nbins vs. nperseg when nbins gets small.
+    # Force a default nperseg for the window applied to each segment. Use
+    # the scipy welch() default 256, but enforce scipy conditions on nbins
+    # vs. nperseg when nbins gets small.
     if nbins < 256:
         nperseg = nbins
     else:
         nperseg = 256
+    # Every call to the SDR must hold at least one whole segment, otherwise
+    # there is nothing to estimate a spectrum from. Shrink the segments to fit,
+    # as welch() does.
+    if num_samp < nperseg:
+        logging.warning('num_samp={} is shorter than nperseg={}, using nperseg={}'.format(num_samp, nperseg, num_samp))
+        nperseg = num_samp
+    win = get_window(WINDOW, nperseg)
+    # Factor converting averaged power spectra to PSD, see below
+    psd_norm = ((win.sum()**2) / (win*win).sum()) / rate
+    # The SDR samples are only 8 bit, so single precision is plenty and
+    # halves the memory traffic of the FFTs
+    win = win.astype(np.float32)
 
     try:
         if sdr is None:
@@ -328,17 +546,21 @@ def run_spectrum_int(num_samp, nbins, gain, rate, fc, t_int, sdr=None):
         logging.debug('  => est. num of calls: {}'.format(num_loops - 1))
 
         # Set up arrays to store power spectrum calculated from I-Q samples
-        freqs = np.zeros(nbins)
+        freqs = fftfreq(nbins, 1. / rate)
         p_xx_tot = np.zeros(nbins)
         cnt = 0
+        # Samples from several calls to the SDR are buffered so that their
+        # spectra can be computed together in a single batch of FFTs
+        iq_batch = np.empty((_BATCH_CALLS, num_samp), dtype=np.complex64)
+        k = 0
 
         # Set the baseline time
         start_time = time.time()
         logging.info('Integration began at {}'.format(time.strftime('%a, %d %b %Y %H:%M:%S', time.localtime(start_time))))
         # Estimate the power spectrum by Bartlett's method.
         # Following https://en.wikipedia.org/wiki/Bartlett%27s_method: 
-        # Use scipy.signal.welch to compute one spectrum for each timeseries
-        # of samples from a call to the SDR.
+        # Use _sum_spectra to compute one spectrum for each timeseries
+        # of samples from a call to the SDR, as scipy.signal.welch would.
         # The scipy.signal.welch() method with noverlap=0 is equivalent to 
         # Bartlett's method, which estimates the spectral content of a time-
         # series by splitting our num_samp array into K segments of length
@@ -352,24 +574,19 @@ def run_spectrum_int(num_samp, nbins, gain, rate, fc, t_int, sdr=None):
         
         # Time integration loop
         # collect num_loops * num_samp samples total
-        for j in range(num_loops):
-            iq = sdr.read_samples(num_samp)
-            # compensate for DC spike
-            iq = (iq.real - iq.real.mean()) + (1j * (iq.imag - iq.imag.mean()))
-
-            # estimate power spectrum of current samples
-            freqs, p_xx = welch(
-                  iq, 
-                  fs=rate, 
-                  nperseg=nperseg, 
-                  nfft=nbins, 
-                  noverlap=0, 
-                  scaling='spectrum', 
-                  window=WINDOW, 
-                  detrend=False, 
-                  return_onesided=False)
-            p_xx_tot += p_xx
-            cnt += 1
+        # The samples are streamed asynchronously, so that the SDR keeps
+        # sampling while each batch is processed.
+        with closing(_stream_samples(sdr, num_samp, num_loops)) as stream:
+            for j, iq in enumerate(stream):
+                iq_batch[k] = iq
+                k += 1
+                if k < _BATCH_CALLS and j < num_loops - 1:
+                    continue
+
+                # estimate power spectrum of current batch of samples
+                p_xx_tot += _sum_spectra(iq_batch[:k], win, nbins)
+                cnt += k
+                k = 0
 
         # Compute the average power spectrum based on the number of spectra read
         p_xx_tot /= cnt
@@ -396,8 +613,7 @@ def run_spectrum_int(num_samp, nbins, gain, rate, fc, t_int, sdr=None):
         # instead. Then divide by the bandwidth to get the power per unit 
         # frequency.
         # See the scipy docs for _spectral_helper().
-        win = get_window(WINDOW, nperseg)
-        p_avg_hz = p_xx_tot * ((win.sum()**2) / (win*win).sum()) / rate
+        p_avg_hz = p_xx_tot * psd_norm
 
         # Convert to "dB/Hz" if desired
         #p_avg_db_hz = 10. * np.log10(p_avg_hz)
@@ -407,8 +623,8 @@ def run_spectrum_int(num_samp, nbins, gain, rate, fc, t_int, sdr=None):
             # nice and tidy
             sdr.close()
 
-    except:
-        print('Unexpected error:', sys.exc_info()[0])
+    except Exception:
+        logging.exception('sdr loop failed')
         raise
     finally:
         if sdr is not None and close_sdr:
@@ -426,6 +642,10 @@ def run_fswitch_int(num_samp, nbins, gain, rate, fc, fthrow, t_int, fswitch=10,
           As a consequence, the minimum integration time is 2*(1/fswitch)
           to ensure the user gets at least one spectrum taken on each
           frequency of interest.
+          Each dwell is streamed asynchronously in its own session, and the
+          SDR is only retuned between sessions, never while streaming. As
+          with synchronous reads, the first samples of a dwell may still be
+          affected by the tuner settling after the retune.
     
     Parameters
     ----------
@@ -470,13 +690,25 @@ def run_fswitch_int(num_samp, nbins, gain, rate, fc, fthrow, t_int, fswitch=10,
     # Force a choice of window to allow converting to PSD after averaging
     # power spectra
     WINDOW = 'hann'
-    # Force a default nperseg for welch() because we need to get a window
-    # of this size later. Use the scipy default 256, but enforce scipy 
-    # conditions on nbins vs. nperseg when nbins gets small.
+    # Force a default nperseg for the window applied to each segment. Use
+    # the scipy welch() default 256, but enforce scipy conditions on nbins
+    # vs. nperseg when nbins gets small.
     if nbins < 256:
         nperseg = nbins
     else:
         nperseg = 256
+    # Every call to the SDR must hold at least one whole segment, otherwise
+    # there is nothing to estimate a spectrum from. Shrink the segments to fit,
+    # as welch() does.
+    if num_samp < nperseg:
+        logging.warning('num_samp={} is shorter than nperseg={}, using nperseg={}'.format(num_samp, nperseg, num_samp))
+        nperseg = num_samp
+    win = get_window(WINDOW, nperseg)
+    # Factor converting averaged power spectra to PSD, see below
+    psd_norm = ((win.sum()**2) / (win*win).sum()) / rate
+    # The SDR samples are only 8 bit, so single precision is plenty and
+    # halves the memory traffic of the FFTs
+    win = win.astype(np.float32)
 
     # Check inputs:
     assert t_int >= 2.0 * (1.0/fswitch), '''At t_int={} s, frequency switching at fswitch={} Hz means the switching period is longer than integration time. Please choose a longer integration time or shorter switching frequency to ensure enough integration time to dwell on each frequency.'''.format(t_int, fswitch)
@@ -514,20 +746,24 @@ def run_fswitch_int(num_samp, nbins, gain, rate, fc, fthrow, t_int, fswitch=10,
         logging.debug('  => num dwells total: {}'.format(num_dwells))
 
         # Set up arrays to store power spectrum calculated from I-Q samples
-        freqs_on = np.zeros(nbins)
-        freqs_off = np.zeros(nbins)
-        p_xx_on = np.zeros(nbins)
-        p_xx_off = np.zeros(nbins)
-        cntOn = 0
-        cntOff = 0
+        freqs_on = fftfreq(nbins, 1. / rate)
+        freqs_off = freqs_on.copy()
+        # Accumulators are indexed by dwell parity: 0 on fc, 1 on fthrow
+        dwell_fc = (fc, fthrow)
+        p_xx_acc = np.zeros((2, nbins))
+        cnt = [0, 0]
+        # Samples from several calls to the SDR are buffered so that their
+        # spectra can be computed together in a single batch of FFTs
+        iq_batch = np.empty((_BATCH_CALLS, num_samp), dtype=np.complex64)
+        k = 0
 
         # Set the baseline time
         start_time = time.time()
         logging.info('Integration began at {}'.format(time.strftime('%a, %d %b %Y %H:%M:%S', time.localtime(start_time))))
         # Estimate the power spectrum by Bartlett's method.
         # Following https://en.wikipedia.org/wiki/Bartlett%27s_method: 
-        # Use scipy.signal.welch to compute one spectrum for each timeseries
-        # of samples from a call to the SDR.
+        # Use _sum_spectra to compute one spectrum for each timeseries
+        # of samples from a call to the SDR, as scipy.signal.welch would.
         # The scipy.signal.welch() method with noverlap=0 is equivalent to 
         # Bartlett's method, which estimates the spectral content of a time-
         # series by splitting our num_samp array into K segments of length
@@ -542,53 +778,30 @@ def run_fswitch_int(num_samp, nbins, gain, rate, fc, fthrow, t_int, fswitch=10,
         # Swap between the two specified frequencies, integrating signal.
         # Time integration loop
         for i in range(num_dwells):
-            tick = (i%2 == 0)
-            # odd dwells: fiducial frequency
-            if tick:
-                sdr.fc = fc
-            # even dwells: shifted frequency
-            else:
-                sdr.fc = fthrow
-            # for current dwell, collect num_loops * num_samp samples total
-            for j in range(num_loops):
-                iq = sdr.read_samples(num_samp)
-                # compensate for DC spike
-                iq = (iq.real - iq.real.mean()) + (1j * (iq.imag - iq.imag.mean()))
-
-                # estimate power spectrum of current samples
-                if tick:
-                    freqs_on, p_xx = welch(
-                        iq,
-                        fs=rate,
-                        nperseg=nperseg,
-                        nfft=nbins,
-                        noverlap=0,
-                        scaling='spectrum',
-                        window=WINDOW,
-                        detrend=False,
-                        return_onesided=False
-                    )
-                    p_xx_on += p_xx
-                    cntOn += 1
-                else:
-                    freqs_off, p_xx = welch(
-                        iq,
-                        fs=rate,
-                        nperseg=nperseg,
-                        nfft=nbins,
-                        noverlap=0,
-                        scaling='spectrum',
-                        window=WINDOW,
-                        detrend=False,
-                        return_onesided=False
-                    )
-                    p_xx_off += p_xx
-                    cntOff += 1
+            # even dwells: fiducial frequency, odd dwells: shifted frequency
+            idx = i % 2
+            sdr.fc = dwell_fc[idx]
+            # for current dwell, collect num_loops * num_samp samples total,
+            # streamed asynchronously so that the SDR keeps sampling while
+            # each batch is processed
+            with closing(_stream_samples(sdr, num_samp, num_loops)) as stream:
+                for j, iq in enumerate(stream):
+                    iq_batch[k] = iq
+                    k += 1
+                    # a batch never spans two dwells
+                    if k < _BATCH_CALLS and j < num_loops - 1:
+                        continue
+
+                    # estimate power spectrum of current batch of samples
+                    p_xx_acc[idx] += _sum_spectra(iq_batch[:k], win, nbins)
+                    cnt[idx] += k
+                    k = 0
         
         # Compute the average power spectrum based on the number of spectra read
-        # cnt/2 is the number of spectra around the fiducial freq/shifted freq
-        p_xx_on  /= cntOn
-        p_xx_off /= cntOff
+        # around the fiducial freq/shifted freq
+        cntOn, cntOff = cnt
+        p_xx_on = p_xx_acc[0] / cntOn
+        p_xx_off = p_xx_acc[1] / cntOff
 
         end_time = time.time()
         logging.info('Integration ended at {} after {} seconds.'.format(time.strftime('%a, %d %b %Y %H:%M:%S'), end_time-start_time))
@@ -616,22 +829,21 @@ def run_fswitch_int(num_samp, nbins, gain, rate, fc, fthrow, t_int, fswitch=10,
         # instead. Then divide by the bandwidth to get the power per unit 
         # frequency.
         # See the scipy docs for _spectral_helper().
-        win = get_window(WINDOW, nperseg)
-        p_avg_on_hz = p_xx_on * ((win.sum()**2) / (win*win).sum()) / rate
-        p_avg_off_hz = p_xx_off * ((win.sum()**2) / (win*win).sum()) / rate
+        p_avg_on_hz = p_xx_on * psd_norm
+        p_avg_off_hz = p_xx_off * psd_norm
 
         # Fold switched power spectra
         #from .post_process import f_throw_fold 
         #freqs_fold, p_fold = f_throw_fold(freqs_on, freqs_off, p_avg_on, p_avg_off)
-        #p_fold_hz = p_fold * ((win.sum()**2) / (win*win).sum()) / rate
+        #p_fold_hz = p_fold * psd_norm
 
 
         if close_sdr:
             # nice and tidy
             sdr.close()
 
-    except:
-        print('Unexpected error:', sys.exc_info()[0])
+    except Exception:
+        logging.exception('sdr loop failed')
         raise
     finally:
         if sdr is not None and close_sdr:
@@ -642,7 +854,20 @@ def run_fswitch_int(num_samp, nbins, gain, rate, fc, fthrow, t_int, fswitch=10,
 
 def save_spectrum(filename, freqs, p_xx):
     '''
-    Save the results of integration to a file.
+    Save the results of integration to a binary file in .npy format, as an
+    array with columns of frequency and power. The file is written to
+    `filename` as given, without np.save adding a .npy suffix, and can be
+    read back with `np.load(filename)`.
+    '''
+    with open(filename, 'wb') as f:
+        np.save(f, np.column_stack((freqs, p_xx)))
+    return
+
+
+def save_spectrum_txt(filename, freqs, p_xx):
+    '''
+    Save the results of integration to a human-readable text file. This is
+    much slower than `save_spectrum` for spectra with many bins.
     '''
     header='\n\n\n\n\n'
     np.savetxt(filename, np.column_stack((freqs, p_xx)), delimiter=' ', header=header)